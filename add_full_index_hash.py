@@ -20,11 +20,46 @@ import getpass
 import re
 from sqlalchemy import create_engine
 
+from flatfile_parser import INDEX_COLUMNS as CATALOG_INDEX_COLUMNS
+from storage_backends import (CATALOG_COLUMNS, CATALOG_TABLE,
+    CHECKPOINT_TABLE, PostgresBackend)
+
 # Index columns are identified by having one of these substrings.
 INDEX_COLUMNS = [ "Facility number", "Unit line number", "unit type",
     "provider line number", "Case Identification", "Cluster number",
     "Household number", "Country code" ]
 
+# Maps information_schema data types back to DataDictionary variable types.
+PG_VARIABLE_TYPES = { "integer" : "int32", "bigint" : "int64",
+    "real" : "float32", "double precision" : "float32", "text" : "string",
+    "character varying" : "string", "boolean" : "bool" }
+
+
+# Tables loaded before flatfile_parser.py wrote a variable catalog have no
+# catalog rows.  Fill them in from information_schema, so that they are not
+# lost to the lookups below; later runs find nothing left to backfill.
+def backfill_catalog(backend):
+  backend.ensure_catalog()
+  res = backend.execute(
+      'SELECT table_name, column_name, data_type '
+      'FROM information_schema.columns '
+      'WHERE table_name ILIKE \'DHS_%\' '
+      'AND table_name NOT IN (SELECT table_name FROM ' + CATALOG_TABLE + ') '
+      'ORDER BY table_name, ordinal_position')
+  catalog_rows = []
+  for tname, cname, data_type in res.fetchall():
+    is_index = any(re.search(re.escape(c), cname, re.IGNORECASE)
+                   for c in CATALOG_INDEX_COLUMNS)
+    if cname == 'full_index_hash':
+      is_index = True
+    catalog_rows.append((re.sub('-\d+$', '', tname), tname,
+        cname.split(' ')[0], cname, PG_VARIABLE_TYPES.get(data_type, data_type),
+        None, is_index))
+  backend.append(CATALOG_TABLE, [name for name, _ in CATALOG_COLUMNS],
+                 catalog_rows)
+  backend.commit()
+  print('Backfilled ' + str(len(catalog_rows)) + ' catalog rows.')
+
 
 def main():
   pg_username = input("Please enter Postgres username:")
@@ -33,23 +68,39 @@ def main():
   pg_login = pg_username + ":" + pg_password
   pg_conn_str = 'postgresql://' + pg_login + '@localhost:5432/dhs_data'
   engine = create_engine(pg_conn_str, echo=False, paramstyle='format')
+
+  backend = PostgresBackend(pg_conn_str)
+  backfill_catalog(backend)
+  backend.ensure_checkpoints()
+  backend.close()
   
+  # Both lookups go through the variable catalog written by
+  # flatfile_parser.py rather than scanning information_schema.
   has_full_index_query = (
       'SELECT table_name '
-      'FROM information_schema.columns '
-      'WHERE table_name ILIKE \'DHS_%%\' '
-      'AND column_name = \'full_index_hash\' '
+      'FROM ' + CATALOG_TABLE + ' '
+      'WHERE column_name = \'full_index_hash\' '
       'ORDER BY 1 ASC')
   
+  # Partially loaded tables are skipped: once hashed, full_index_hash is NOT
+  # NULL and a resumed load could no longer insert into them.  Tables loaded
+  # before checkpoints existed have no checkpoint row and are kept.
   get_index_columns_query = (
-      'SELECT table_name, column_name '
-      'FROM information_schema.columns '
-      'WHERE table_name ILIKE \'DHS_%%\' '
-      'AND (column_name ILIKE \'%%')
-  get_index_columns_query += '%%\' OR column_name ILIKE \'%%'.join(INDEX_COLUMNS)
-  get_index_columns_query += '%%\') ORDER BY 1,2 ASC'
+      'SELECT survey, table_name, column_name '
+      'FROM ' + CATALOG_TABLE + ' '
+      'WHERE is_index '
+      'AND table_name NOT IN (SELECT table_name FROM ' + CHECKPOINT_TABLE + ' '
+      'WHERE NOT complete) '
+      'ORDER BY 2,3 ASC')
+  index_col_pattern = '|'.join(re.escape(c) for c in INDEX_COLUMNS)
+
+  add_catalog_entry_query = (
+      'INSERT INTO ' + CATALOG_TABLE + ' (survey, table_name, column_name, '
+      'column_type, is_index) '
+      'VALUES (%s, %s, \'full_index_hash\', \'int32\', TRUE)')
 
   table_queries = {}
+  table_surveys = {}
   done_tables = set()
   
 #  print(get_index_columns_query)
@@ -62,10 +113,13 @@ def main():
     for row in res:
       tname = row['table_name']
       if tname in done_tables: continue
+      if not re.search(index_col_pattern, row['column_name'], re.IGNORECASE):
+        continue
       cname = '\"' + row['column_name'] + '\"'
       if re.search("number", cname, re.IGNORECASE):
         cname += '::text'
     
+      table_surveys[tname] = row['survey']
       if not tname in table_queries:
         table_queries[tname] = (
             'UPDATE \"' + tname + '\" '
@@ -84,6 +138,7 @@ def main():
       con.execute(
           'ALTER TABLE \"' + tname + '\" '
           'ALTER COLUMN full_index_hash SET NOT NULL')
+      con.execute(add_catalog_entry_query, (table_surveys[tname], tname))
     
     
 if __name__ == '__main__':
@@ -9,6 +9,7 @@
 
 #import csv
 import glob
+import hashlib
 import optparse
 import os
 #import pandas
@@ -18,8 +19,7 @@ import tempfile
 import timeit
 import zipfile
 
-from odo import drop, odo
-#from sqlalchemy import create_engine
+from storage_backends import get_backend
 
 # India has data broken down at the province / district level, with a two-
 # letter code for each region.  This causes a problem when we hit Kerala,
@@ -80,7 +80,7 @@ NULL_INT_VALUE = -999
 NULL_FLOAT_VALUE = -999.0
 
 RECORD_LIMIT = 0
-MAX_COL_CNT = 700    # psycopg2, and hence Postgres, have a hard cap of 1600.
+COMMIT_RECORD_CNT = 10000   # Records per committed, checkpointed batch.
 FLOAT_ERROR = 0.001
 
 
@@ -211,7 +211,6 @@ class DataDictionary:
       # The data dictionary for first time of breastfeeding is special and
       # requires separate interpretation.
       if re.search(BF_IDENTIFIER, vbl_name):
-        self.variable_type[vbl_label] = "string"
         value = int(value)
         if value == 0:
           record_dict[vbl_name] = "Immediately"
@@ -321,21 +320,46 @@ def clean_name(vbl_name):
   return name
 
 
+# A cheap stand-in for a full checksum of a (possibly very large) data file:
+# the hash of its first and last blocks.  Enough to tell a re-downloaded,
+# corrected file from the one a checkpoint was taken against.
+def data_fingerprint(path, block_size=65536):
+  digest = hashlib.md5()
+  with open(path, mode="rb") as data:
+    digest.update(data.read(block_size))
+    data.seek(max(0, os.path.getsize(path) - block_size))
+    digest.update(data.read(block_size))
+  return digest.hexdigest()
+
+
 def main():
-  parser = optparse.OptionParser(usage='%prog data_dir')
+  parser = optparse.OptionParser(usage='%prog [options] data_dir')
+  parser.add_option('--backend', dest='backend', default='postgres',
+                    choices=['postgres', 'sqlite'],
+                    help='Storage backend to load into (postgres or sqlite).')
+  parser.add_option('--sqlite_db', dest='sqlite_db', default='dhs_data.db',
+                    help='Database file to use with the sqlite backend.')
+  parser.add_option('--no_resume', dest='resume', default=True,
+                    action='store_false',
+                    help='Ignore load checkpoints and reload from scratch.')
   opts, args = parser.parse_args()
   if len(args) < 1:
     parser.error('Please specify a data directory.')
   elif len(args) > 1:
     parser.error('Too many arguments.')
   
-  aws_ip = input("IP Address of the AWS instance:")
-  pg_username = input("Please enter Postgres username:")
-  pg_password = input("Password:")
+  if opts.backend == 'postgres':
+    aws_ip = input("IP Address of the AWS instance:")
+    pg_username = input("Please enter Postgres username:")
+    pg_password = input("Password:")
     
-  pg_login = pg_username + ":" + pg_password
-  pg_conn_str = 'postgresql://' + pg_login + '@' + aws_ip + ':5432/dhs_data'
-  #engine = create_engine(pg_conn_str, echo=False, paramstyle='format')
+    pg_login = pg_username + ":" + pg_password
+    pg_conn_str = 'postgresql://' + pg_login + '@' + aws_ip + ':5432/dhs_data'
+    backend = get_backend(opts.backend, pg_conn_str)
+  else:
+    backend = get_backend(opts.backend, opts.sqlite_db)
+  backend.ensure_catalog()
+  backend.ensure_checkpoints()
 
   vbl_pattern = "attrib (?P<label>\S+)\s+(?:length=(?P<length>\$?\d+))?"
   vbl_pattern += "\s*(?:format=(?P<format>\S*)\.)?"
@@ -388,7 +412,7 @@ def main():
     base_table_name += "-v" + survey_version
     table_cnt = 0
     writes_succeeded = True
-    for schemafile in schemafiles:
+    for schemafile in sorted(schemafiles):
       fname = schemafile.split('.')[-2]
       datafile = fname + ".DAT"
       if not datafile in datafiles:
@@ -506,113 +530,154 @@ def main():
             " variables seen.")
       
       data_dict.clean_formats()
+      # parse() decodes the first-breastfeeding field into text, so its
+      # column has to be typed as a string before the tables are laid out.
+      for vbl_label in data_dict.variable_dict:
+        if (vbl_label in data_dict.variable_type and
+            re.search(BF_IDENTIFIER, data_dict.variable_dict[vbl_label])):
+          data_dict.variable_type[vbl_label] = "string"
 
-      # Now we've read off the schema describing how to parse the flat file
-      # records into dataframe records.  Now we just need to do the parsing.
-#      df = pandas.DataFrame(columns=data_dict.vbls_seen)
-      record_cnt = 0
-      data_records = []
-      with open(os.path.join(tmpdir, datafile), mode="r") as data:
-        for record in data:
-#         record = record.decode('utf-8')
-#         print("Length of record = " + str(len(record)))
-          record_cnt += 1
-          # For testing
-          if RECORD_LIMIT > 0 and record_cnt > RECORD_LIMIT: break
-          if record_cnt % 5000 == 0:
-            print ("Read " + str(record_cnt) + " records.")
-          record_dict = data_dict.parse(record)
-#         print("Record has " + str(len(record_dict)) + " entries.")
-          data_records.append(record_dict)
-#        df = df.append(data_records, ignore_index=True)
-      
-      print("Data file read; " + str(record_cnt) + " records seen.")
+      # Work out the chunk tables up front.  The layout has to come out the
+      # same on every run, or a resumed load would append to the wrong
+      # tables, hence the sorting.
+      chunks = []
+      col_cnt = 0
+      col_set = set()
+      col_set |= index_cols
+      columns = sorted(data_dict.vbls_seen)
+      while col_cnt < len(columns):
+        col_set.add(columns[col_cnt])
+        col_cnt += 1
+        if (col_cnt % backend.max_col_cnt) == 0 or col_cnt == len(columns):
+          table_name = base_table_name
+          if table_cnt > 0:
+            table_name += "-" + str(table_cnt)
+          col_headers = sorted(col_set)
+          col_types = []
+          for k in col_headers:
+            if k.split(" ")[0] in data_dict.variable_type:
+              col_types.append(data_dict.variable_type[k.split(" ")[0]])
+            else:
+              col_types.append("int32")
+          chunks.append((table_name, col_headers, col_types))
+          col_set.clear()
+          col_set |= index_cols
+          table_cnt += 1
+      table_names = [chunk[0] for chunk in chunks]
+      # Fingerprint of the layout, so that checkpoints left by a run with a
+      # different layout (another max_col_cnt, a schema parsing change) are
+      # never resumed into.
+      layout_hash = hashlib.md5(repr(chunks).encode("utf-8")).hexdigest()
+      null_values = { "string" : "", "int32" : NULL_INT_VALUE,
+          "float32" : NULL_FLOAT_VALUE, "bool" : False }
+      label_for_name = { data_dict.variable_dict[vbl_label] : vbl_label
+          for vbl_label in data_dict.variable_dict }
+      data_path = os.path.join(tmpdir, datafile)
+      data_id = base_filename + "/" + datafile
+      data_size = os.path.getsize(data_path)
+      data_hash = data_fingerprint(data_path)
 
-      if record_cnt == 0:
-        print("No records found; misread file?")
-        writes_succeeded = False
+      def write_batch(data_records, byte_offset, record_cnt, complete=False):
+        for table_name, col_headers, col_types in chunks:
+          temp_table = []
+          for row in data_records:
+            temp_table.append(tuple(
+                row[k] if k in row else null_values[vbl_type]
+                for k, vbl_type in zip(col_headers, col_types)))
+          backend.append(table_name, col_headers, temp_table)
+          backend.write_checkpoint((table_name, base_table_name, data_id,
+              data_size, data_hash, layout_hash, byte_offset, record_cnt,
+              complete))
+        backend.commit()
 
       try:
-        col_cnt = 0
-        col_set = set()
-        col_set |= index_cols
-        columns = list(data_dict.vbls_seen)
-        while col_cnt < len(columns):
-          col_set.add(columns[col_cnt])
-          col_cnt += 1
-          if (col_cnt % MAX_COL_CNT) == 0 or col_cnt == len(columns):
-            table_name = base_table_name
-            if table_cnt > 0:
-              table_name += "-" + str(table_cnt)
-            print("Writing to " + table_name)
-#            export_df = df.loc[:, list(col_set)]
-#            dshape = export_df.shape
-            #print(export_df.shape)
-            #export_df.to_sql(name=table_name, con=engine, if_exists='replace')
-            try:
-              drop(pg_conn_str + "::" + table_name)
-            except:
-              print(table_name + " does not exist.  Creating from scratch.")
-            #table_csv = os.path.join(tmpdir, table_name + ".csv")
-            #print("Writing temp CSV to " + table_csv)
-#            export_df.to_csv(table_csv)
-            #with open(table_csv, "w") as tfh:
-            col_headers = list(col_set)
-            #  writer = csv.DictWriter(tfh, col_headers)
-            #  writer.writeheader()
-            temp_table = []
-#            header_str = ""
-#            type_str = ""
-            dshape_str = "var * {"
-            for k in col_headers:
-#              print("|" + k.split(" ")[0] + "|")
-#              print(data_dict.variable_type[k.split(" ")[0]])
-              #header_str += "\'" + k + "\', "
-              dshape_str += "\"" + k + "\": "
-              if k.split(" ")[0] in data_dict.variable_type:
-                #type_str += data_dict.variable_type[k] + ", "
-                dshape_str += data_dict.variable_type[k.split(" ")[0]] + ", "
-              else:
-                dshape_str += "int32, "
-                #type_str += "int32, "
-#             dshape_str += "\"" + k + "\": " + data_dict.variable_type[k] + ","
-            #dshape_str = "var * struct[[" + header_str[:-2] + "],["
-            #dshape_str += type_str[:-2] + "]]"
-            dshape_str = dshape_str[:-2] + "}"
-            for row in data_records:
-              temp_row = {k: row[k] for k in col_headers if k in row}
-              temp_row.update({k: "" for k in col_headers if (
-                  k.split(" ")[0] in data_dict.variable_type and
-                  data_dict.variable_type[k.split(" ")[0]] == "string" and
-                  not k in row)})
-              temp_row.update({k: NULL_INT_VALUE for k in col_headers if (
-                  k.split(" ")[0] in data_dict.variable_type and
-                  data_dict.variable_type[k.split(" ")[0]] == "int32" and
-                  not k in row)})
-              temp_row.update({k: NULL_FLOAT_VALUE for k in col_headers if (
-                  k.split(" ")[0] in data_dict.variable_type and
-                  data_dict.variable_type[k.split(" ")[0]] == "float32" and
-                  not k in row)})
-              temp_row.update({k: False for k in col_headers if (
-                  k.split(" ")[0] in data_dict.variable_type and
-                  data_dict.variable_type[k.split(" ")[0]] == "bool" and
-                  not k in row)})
-              temp_row.update({k: NULL_INT_VALUE for k in col_headers if not (
-                  k.split(" ")[0] in data_dict.variable_type or k in row)})
-              temp_table.append(temp_row)
-          #      writer.writerow(temp_row)
-            print("Wrote temp CSV")
-            start_time = timeit.default_timer()
-          #  odo(table_csv, pg_conn_str + "::" + table_name)
-            odo(temp_table, pg_conn_str + "::" + table_name,
-                dshape = dshape_str)
-            elapsed = timeit.default_timer() - start_time
-            col_set.clear()
-            col_set |= index_cols
-            table_cnt += 1
-            print("Finished writing to " + table_name + " in " +
-                  str(elapsed) + "s")
+        # A previous run of the same data file (same name, size and
+        # fingerprint) with the same layout left checkpoints behind for every
+        # chunk table: pick up where it stopped instead of rebuilding.
+        checkpoints = backend.read_checkpoints(table_names)
+        resume_point = set(cp[2:] for cp in checkpoints.values())
+        if (opts.resume and len(checkpoints) == len(chunks) and
+            len(resume_point) == 1 and
+            list(resume_point)[0][0:4] == (data_id, data_size, data_hash,
+                                           layout_hash)):
+          byte_offset, record_cnt, complete = list(resume_point)[0][4:]
+          print("Resuming " + datafile + " at record " + str(record_cnt) +
+                " (byte " + str(byte_offset) + ")")
+        else:
+          byte_offset, record_cnt, complete = 0, 0, False
+          # Chunk tables an earlier layout made for this data file, which
+          # the current one no longer produces.
+          for table_name in backend.checkpointed_tables(data_id):
+            if table_name in table_names: continue
+            print("Dropping stale " + table_name)
+            backend.clear_checkpoint(table_name)
+            backend.clear_catalog(table_name)
+            backend.drop_table(table_name)
+          for table_name, col_headers, col_types in chunks:
+            print("Creating " + table_name)
+            # The old checkpoint goes in the same transaction as the drop
+            # and create (for sqlite3 the DELETE is what opens it), and all
+            # of it commits together in write_batch.
+            backend.clear_checkpoint(table_name)
+            backend.drop_table(table_name)
+            backend.create_table(table_name, list(zip(col_headers, col_types)))
+            catalog_rows = []
+            for k, vbl_type in zip(col_headers, col_types):
+              vbl_label = label_for_name.get(k, k.split(" ")[0])
+              catalog_rows.append((base_table_name, table_name, vbl_label, k,
+                  vbl_type, data_dict.variable_format_dict.get(vbl_label),
+                  k in index_cols))
+            backend.write_catalog(table_name, catalog_rows)
+          write_batch([], 0, 0)
+
+        # Now we've read off the schema describing how to parse the flat file
+        # records into dataframe records.  Now we just need to do the parsing,
+        # committing every COMMIT_RECORD_CNT records along with a checkpoint.
+        # The file is read as bytes so that tell() gives offsets we can seek
+        # back to on a rerun.
+        start_time = timeit.default_timer()
+        if not complete:
+          data_records = []
+          with open(data_path, mode="rb") as data:
+            data.seek(byte_offset)
+            for line in data:
+              # For testing
+              if RECORD_LIMIT > 0 and record_cnt >= RECORD_LIMIT: break
+              record_cnt += 1
+              if record_cnt % 5000 == 0:
+                print ("Read " + str(record_cnt) + " records.")
+              record = line.decode("Latin-1").replace("\r\n", "\n")
+              data_records.append(data_dict.parse(record))
+              if len(data_records) >= COMMIT_RECORD_CNT:
+                write_batch(data_records, data.tell(), record_cnt)
+                data_records = []
+            for table_name, col_headers, col_types in chunks:
+              table_index_cols = [k for k in col_headers if k in index_cols]
+              if table_index_cols:
+                backend.create_index(table_name, table_index_cols)
+            write_batch(data_records, data.tell(), record_cnt, complete=True)
+        elapsed = timeit.default_timer() - start_time
+
+        print("Data file read; " + str(record_cnt) + " records seen.")
+        if record_cnt == 0:
+          print("No records found; misread file?")
+          writes_succeeded = False
+
+        for table_name in table_names:
+          row_cnt = backend.count_rows(table_name)
+          if row_cnt != record_cnt:
+            print(table_name + " has " + str(row_cnt) + " rows; expected " +
+                  str(record_cnt))
+            writes_succeeded = False
+        print("Finished writing to " + ", ".join(table_names) + " in " +
+              str(elapsed) + "s")
       except:
+        # On a lost connection the rollback itself fails; that must not
+        # stop the temp files being removed or the other zips being tried.
+        try:
+          backend.rollback()
+        except:
+          print("Rollback failed; the database connection may be lost.")
         writes_succeeded = False
         print("Could not write tables for " + schemafile + " in " + zfile)
         
@@ -620,6 +685,8 @@ def main():
     if writes_succeeded:
       os.remove(zfile)
 
+  backend.close()
+
 #    df.to_sql(name=table_name, con=engine, if_exists='replace')
 #    print(table_name)
 #    print(df)
@@ -0,0 +1,229 @@
+#!/usr/bin/python
+
+# Storage backends for the DHS flat file parser.  Each backend knows how to
+# create, drop, bulk append to and index the chunked DHS tables, so that the
+# parser itself does not care whether it is talking to our Postgres instance
+# or to a local SQLite file (handy for offline loads and for testing).
+
+import hashlib
+import sqlite3
+
+# Number of rows handed to the driver per executemany / execute_values call.
+INSERT_BATCH_SIZE = 5000
+
+# The variable catalog has one row per column of every loaded chunk table, so
+# that index columns (and surveys containing a given variable) can be found
+# without scanning information_schema.
+CATALOG_TABLE = "variable_catalog"
+CATALOG_COLUMNS = [ ("survey", "string"), ("table_name", "string"),
+    ("sas_label", "string"), ("column_name", "string"),
+    ("column_type", "string"), ("value_format", "string"),
+    ("is_index", "bool") ]
+CATALOG_INDEXES = [ ["sas_label"], ["column_name"], ["table_name"],
+    ["survey"] ]
+
+# Load checkpoints: after every committed batch, the byte offset into the .DAT
+# file and the number of records loaded so far are recorded per chunk table,
+# in the same transaction as the rows themselves.
+CHECKPOINT_TABLE = "load_checkpoints"
+CHECKPOINT_COLUMNS = [ ("table_name", "string"), ("survey", "string"),
+    ("data_file", "string"), ("data_size", "int64"), ("data_hash", "string"),
+    ("layout_hash", "string"), ("byte_offset", "int64"),
+    ("record_cnt", "int64"), ("complete", "bool") ]
+
+# Headroom left under the backend column limit for the index columns, which
+# are repeated in every chunk table on top of the regular columns.
+INDEX_COL_SLACK = 50
+
+# Bound parameter limit of SQLite builds older than 3.32.
+SQLITE_LEGACY_VARIABLE_LIMIT = 999
+
+
+# Subclasses open self.conn (a DB-API connection) and provide:
+#   max_col_cnt  Maximum number of (non-index) columns per chunk table.
+#   placeholder  The driver's bound parameter marker.
+#   append(table_name, col_names, rows)
+#                Inserts rows (sequences ordered as col_names) in large
+#                batches.  Nothing is committed there; the caller decides
+#                where the transaction ends.
+class StorageBackend:
+  # Maps the DataDictionary variable types to SQL column types.
+  type_map = { "int32" : "INTEGER", "int64" : "BIGINT", "float32" : "REAL",
+      "string" : "TEXT", "bool" : "BOOLEAN" }
+
+  def __init__(self):
+    self.conn = None
+
+  def quote(self, name):
+    return '"' + name.replace('"', '""') + '"'
+
+  def execute(self, sql, params=None):
+    cursor = self.conn.cursor()
+    if params is None:
+      cursor.execute(sql)
+    else:
+      cursor.execute(sql, params)
+    return cursor
+
+  # Not committed; Postgres DDL is transactional, so a rebuilt table can be
+  # dropped and recreated in one go.
+  def drop_table(self, table_name):
+    self.execute("DROP TABLE IF EXISTS " + self.quote(table_name))
+
+  # columns is a list of (column name, DataDictionary variable type) pairs.
+  def create_table(self, table_name, columns, if_not_exists=False):
+    col_defs = [self.quote(name) + " " + self.type_map.get(vbl_type, "INTEGER")
+                for name, vbl_type in columns]
+    create_sql = "CREATE TABLE "
+    if if_not_exists:
+      create_sql += "IF NOT EXISTS "
+    self.execute(create_sql + self.quote(table_name) + " (" +
+                 ", ".join(col_defs) + ")")
+
+  def delete_rows(self, table_name, column, value):
+    self.execute("DELETE FROM " + self.quote(table_name) + " WHERE " +
+                 self.quote(column) + " = " + self.placeholder, (value,))
+
+  def create_index(self, table_name, col_names):
+    # Postgres truncates identifiers at 63 bytes, and our table names alone
+    # can run past that, so name the index after a hash instead.
+    index_name = "idx_" + hashlib.md5(
+        (table_name + "|" + "|".join(col_names)).encode("utf-8")).hexdigest()
+    self.execute("CREATE INDEX IF NOT EXISTS " + self.quote(index_name) +
+                 " ON " + self.quote(table_name) + " (" +
+                 ", ".join(self.quote(c) for c in col_names) + ")")
+
+  def ensure_catalog(self):
+    self.create_table(CATALOG_TABLE, CATALOG_COLUMNS, if_not_exists=True)
+    for col_names in CATALOG_INDEXES:
+      self.create_index(CATALOG_TABLE, col_names)
+    self.commit()
+
+  # Replaces the catalog entries for one chunk table.  rows are ordered as
+  # CATALOG_COLUMNS.
+  def write_catalog(self, table_name, rows):
+    self.clear_catalog(table_name)
+    self.append(CATALOG_TABLE, [name for name, _ in CATALOG_COLUMNS], rows)
+
+  def clear_catalog(self, table_name):
+    self.delete_rows(CATALOG_TABLE, "table_name", table_name)
+
+  def ensure_checkpoints(self):
+    self.create_table(CHECKPOINT_TABLE, CHECKPOINT_COLUMNS, if_not_exists=True)
+    self.create_index(CHECKPOINT_TABLE, ["table_name"])
+    self.commit()
+
+  # Returns a map from table name to its checkpoint row, ordered as
+  # CHECKPOINT_COLUMNS, for those of table_names that have one.
+  def read_checkpoints(self, table_names):
+    checkpoints = dict()
+    for table_name in table_names:
+      row = self.execute(
+          "SELECT " + ", ".join(self.quote(name) for name, _ in
+                                CHECKPOINT_COLUMNS) +
+          " FROM " + self.quote(CHECKPOINT_TABLE) + " WHERE " +
+          self.quote("table_name") + " = " + self.placeholder,
+          (table_name,)).fetchone()
+      if row is not None:
+        checkpoints[table_name] = tuple(row)
+    return checkpoints
+
+  # Returns the tables holding checkpoints for the given data file.
+  def checkpointed_tables(self, data_file):
+    return [row[0] for row in self.execute(
+        "SELECT " + self.quote("table_name") + " FROM " +
+        self.quote(CHECKPOINT_TABLE) + " WHERE " + self.quote("data_file") +
+        " = " + self.placeholder, (data_file,)).fetchall()]
+
+  # Not committed; it belongs in the same transaction as the rows it covers.
+  def write_checkpoint(self, row):
+    self.delete_rows(CHECKPOINT_TABLE, "table_name", row[0])
+    self.append(CHECKPOINT_TABLE, [name for name, _ in CHECKPOINT_COLUMNS],
+                [row])
+
+  def clear_checkpoint(self, table_name):
+    self.delete_rows(CHECKPOINT_TABLE, "table_name", table_name)
+
+  def count_rows(self, table_name):
+    return self.execute(
+        "SELECT COUNT(*) FROM " + self.quote(table_name)).fetchone()[0]
+
+  def commit(self):
+    self.conn.commit()
+
+  def rollback(self):
+    self.conn.rollback()
+
+  def close(self):
+    if self.conn is not None:
+      self.conn.close()
+      self.conn = None
+
+
+class PostgresBackend(StorageBackend):
+  max_col_cnt = 700    # psycopg2, and hence Postgres, have a hard cap of 1600.
+  placeholder = "%s"
+
+  def __init__(self, conn_str):
+    StorageBackend.__init__(self)
+    import psycopg2
+    import psycopg2.extras
+    self.extras = psycopg2.extras
+    self.conn = psycopg2.connect(conn_str)
+
+  def append(self, table_name, col_names, rows):
+    # Plain executemany makes one round trip per row with psycopg2;
+    # execute_values packs a whole batch into a single multi-row INSERT.
+    # It %-formats the statement, so any % in a column name is doubled.
+    sql = ("INSERT INTO " + self.quote(table_name).replace("%", "%%") + " (" +
+           ", ".join(self.quote(c).replace("%", "%%") for c in col_names) +
+           ") VALUES %s")
+    self.extras.execute_values(self.conn.cursor(), sql, rows,
+                               page_size=INSERT_BATCH_SIZE)
+
+
+class SqliteBackend(StorageBackend):
+  # SQLite has no 1600 column cap, but is compiled with a limit on columns
+  # per table (SQLITE_MAX_COLUMN, 2000 by default) and on bound parameters
+  # per statement.  Both are checked against the live connection below.
+  max_col_cnt = 1900
+  placeholder = "?"
+  type_map = { "int32" : "INTEGER", "int64" : "INTEGER", "float32" : "REAL",
+      "string" : "TEXT", "bool" : "INTEGER" }
+
+  def __init__(self, db_path):
+    StorageBackend.__init__(self)
+    self.conn = sqlite3.connect(db_path)
+    # Tuned for bulk loading: WAL with synchronous=NORMAL survives an
+    # application crash but skips the per-commit fsync, and the large page
+    # cache keeps index builds in memory.
+    for pragma in ["journal_mode = WAL", "synchronous = NORMAL",
+                   "temp_store = MEMORY", "cache_size = -262144",
+                   "locking_mode = EXCLUSIVE"]:
+      self.conn.execute("PRAGMA " + pragma)
+    if hasattr(self.conn, "getlimit"):
+      limit = min(self.conn.getlimit(sqlite3.SQLITE_LIMIT_COLUMN),
+                  self.conn.getlimit(sqlite3.SQLITE_LIMIT_VARIABLE_NUMBER))
+      self.max_col_cnt = min(self.max_col_cnt, limit - INDEX_COL_SLACK)
+    elif sqlite3.sqlite_version_info < (3, 32, 0):
+      # Connection.getlimit needs Python 3.11; without it, fall back on the
+      # 999 bound parameter limit of SQLite builds older than 3.32.  Newer
+      # builds allow 32766, well above the default column limit.
+      self.max_col_cnt = min(self.max_col_cnt,
+                             SQLITE_LEGACY_VARIABLE_LIMIT - INDEX_COL_SLACK)
+
+  def append(self, table_name, col_names, rows):
+    sql = ("INSERT INTO " + self.quote(table_name) + " (" +
+           ", ".join(self.quote(c) for c in col_names) + ") VALUES (" +
+           ", ".join([self.placeholder] * len(col_names)) + ")")
+    cursor = self.conn.cursor()
+    for start in range(0, len(rows), INSERT_BATCH_SIZE):
+      cursor.executemany(sql, rows[start:start + INSERT_BATCH_SIZE])
+
+
+def get_backend(backend_name, location):
+  if backend_name == "postgres":
+    return PostgresBackend(location)
+  elif backend_name == "sqlite":
+    return SqliteBackend(location)
+  raise ValueError("Unknown storage backend |" + backend_name + "|")
@@ -0,0 +1,202 @@
+#!/usr/bin/python
+
+# Loads a small synthetic DHS survey into a temporary SQLite database, to
+# check the storage backend, the variable catalog and checkpointed resume
+# without needing a Postgres instance.
+
+import os
+import shutil
+import sqlite3
+import sys
+import tempfile
+import unittest
+import zipfile
+from unittest import mock
+
+import flatfile_parser
+import storage_backends
+
+SCHEMA = """  value F00001_
+     1 = "Yes"
+     2 = "No"
+     ;
+  value F00002_
+     1 = "Urban"
+     2 = "Rural"
+     3 = "Other"
+     ;
+  attrib CASEID   length=$15 label="Case Identification";
+  attrib V001     label="Cluster number";
+  attrib V002     label="Household number";
+  attrib V025     format=F00002_. label="Type of place of residence";
+  attrib V101     format=F00001_. label="Has electricity";
+  attrib V437     label="Weight (kilos-1d)";
+  attrib M34      label="When child put to breast";
+  @1    CASEID   $15.
+  @16   V001     4.
+  @20   V002     4.
+  @24   V025     1.
+  @25   V101     1.
+  @26   V437     4.1
+  @30   M34      3.
+  @33   V999     1.
+"""
+RECORD_CNT = 2500
+BASE_TABLE = "DHS_Kenya-Women Recode-v70"
+
+
+class FlatfileParserSqliteTest(unittest.TestCase):
+  def setUp(self):
+    self.tmpdir = tempfile.mkdtemp(prefix='dhs_test-')
+    self.data_dir = os.path.join(self.tmpdir, "in")
+    os.mkdir(self.data_dir)
+    self.db_path = os.path.join(self.tmpdir, "dhs_data.db")
+    self.zip_path = os.path.join(self.data_dir, "KEIR70FL.zip")
+    records = []
+    for i in range(RECORD_CNT):
+      records.append("%15s%4d%4d%d%d%4d%03d1\n" % ("c" + str(i), i // 100,
+          i % 100, i % 3 + 1, i % 2 + 1, 500 + i % 300,
+          [0, 105, 203][i % 3]))
+    with zipfile.ZipFile(self.zip_path, mode="w") as zf_fh:
+      zf_fh.writestr("KEIR70FL.SAS", SCHEMA)
+      zf_fh.writestr("KEIR70FL.DAT", "".join(records))
+
+  def tearDown(self):
+    shutil.rmtree(self.tmpdir)
+
+  def run_parser(self):
+    argv = ["flatfile_parser.py", "--backend", "sqlite", "--sqlite_db",
+            self.db_path, self.data_dir]
+    with mock.patch.object(sys, "argv", argv):
+      flatfile_parser.main()
+
+  def chunk_tables(self, conn):
+    return [row[0] for row in conn.execute(
+        "SELECT DISTINCT table_name FROM variable_catalog ORDER BY 1")]
+
+  def test_load(self):
+    with mock.patch.object(storage_backends.SqliteBackend, "max_col_cnt", 4):
+      self.run_parser()
+    self.assertFalse(os.path.exists(self.zip_path))
+
+    conn = sqlite3.connect(self.db_path)
+    tables = self.chunk_tables(conn)
+    self.assertEqual(tables, [BASE_TABLE, BASE_TABLE + "-1"])
+    for table_name in tables:
+      self.assertEqual(conn.execute(
+          'SELECT COUNT(*) FROM "' + table_name + '"').fetchone()[0],
+          RECORD_CNT)
+
+    catalog = dict(((row[0], row[1]), row[2:]) for row in conn.execute(
+        "SELECT table_name, column_name, sas_label, column_type, "
+        "value_format, is_index FROM variable_catalog"))
+    # Index columns are repeated in every chunk table.
+    for table_name in tables:
+      self.assertEqual(catalog[(table_name, "V001 Cluster number")],
+                       ("V001", "int32", None, 1))
+    bf_table = [t for t in tables
+                if (t, "M34 When child put to breast") in catalog][0]
+    self.assertEqual(catalog[(bf_table, "M34 When child put to breast")],
+                     ("M34", "string", None, 0))
+    residence_table = [t for t in tables
+                       if (t, "V025 Type of place of residence") in catalog][0]
+    self.assertEqual(
+        catalog[(residence_table, "V025 Type of place of residence")],
+        ("V025", "string", "F00002_", 0))
+
+    # Declared column types agree with the catalog.
+    col_types = dict((row[1], row[2]) for row in conn.execute(
+        "PRAGMA table_info(\"" + bf_table + "\")"))
+    self.assertEqual(col_types["M34 When child put to breast"], "TEXT")
+    self.assertEqual(sorted(row[0] for row in conn.execute(
+        'SELECT DISTINCT "M34 When child put to breast" FROM "' +
+        bf_table + '"')), ["3 days", "5 hours", "Immediately"])
+    conn.close()
+
+  def test_resume_after_interrupted_load(self):
+    append = storage_backends.SqliteBackend.append
+    appended_batches = []
+
+    def failing_append(backend, table_name, col_names, rows):
+      if table_name.startswith("DHS_") and rows:
+        if len(appended_batches) >= 1:
+          raise RuntimeError("Simulated disconnect")
+        appended_batches.append(table_name)
+      return append(backend, table_name, col_names, rows)
+
+    with mock.patch.object(flatfile_parser, "COMMIT_RECORD_CNT", 1000):
+      with mock.patch.object(storage_backends.SqliteBackend, "append",
+                             failing_append):
+        self.run_parser()
+      # The failed load keeps its zip, and only the first batch committed.
+      self.assertTrue(os.path.exists(self.zip_path))
+      conn = sqlite3.connect(self.db_path)
+      self.assertEqual(conn.execute(
+          'SELECT byte_offset > 0, record_cnt, complete '
+          'FROM load_checkpoints').fetchall(), [(1, 1000, 0)])
+      self.assertEqual(conn.execute(
+          'SELECT COUNT(*) FROM "' + BASE_TABLE + '"').fetchone()[0], 1000)
+      conn.close()
+
+      self.run_parser()
+    self.assertFalse(os.path.exists(self.zip_path))
+    conn = sqlite3.connect(self.db_path)
+    self.assertEqual(conn.execute(
+        'SELECT record_cnt, complete FROM load_checkpoints').fetchall(),
+        [(RECORD_CNT, 1)])
+    self.assertEqual(conn.execute(
+        'SELECT COUNT(*), COUNT(DISTINCT "CASEID Case Identification") '
+        'FROM "' + BASE_TABLE + '"').fetchone(), (RECORD_CNT, RECORD_CNT))
+    conn.close()
+
+  def test_layout_change_rebuilds(self):
+    append = storage_backends.SqliteBackend.append
+
+    def failing_append(backend, table_name, col_names, rows):
+      if table_name.startswith("DHS_") and rows:
+        raise RuntimeError("Simulated disconnect")
+      return append(backend, table_name, col_names, rows)
+
+    with mock.patch.object(storage_backends.SqliteBackend, "max_col_cnt", 4):
+      with mock.patch.object(storage_backends.SqliteBackend, "append",
+                             failing_append):
+        self.run_parser()
+    # A wider layout no longer needs the -1 chunk table, and must not
+    # resume into the two-table layout left behind.
+    self.run_parser()
+    self.assertFalse(os.path.exists(self.zip_path))
+
+    conn = sqlite3.connect(self.db_path)
+    self.assertEqual(self.chunk_tables(conn), [BASE_TABLE])
+    self.assertEqual(conn.execute(
+        'SELECT table_name, record_cnt, complete '
+        'FROM load_checkpoints').fetchall(), [(BASE_TABLE, RECORD_CNT, 1)])
+    self.assertEqual(conn.execute(
+        "SELECT COUNT(*) FROM sqlite_master WHERE name = ?",
+        (BASE_TABLE + "-1",)).fetchone()[0], 0)
+    self.assertEqual(conn.execute(
+        'SELECT COUNT(*), COUNT("V437 Weight  kilos-1d ") '
+        'FROM "' + BASE_TABLE + '"').fetchone(), (RECORD_CNT, RECORD_CNT))
+    conn.close()
+
+
+  def test_changed_data_file_is_reloaded(self):
+    self.run_parser()
+    # A corrected file of the same name and size is not the one the
+    # completed checkpoint was taken against.
+    with zipfile.ZipFile(self.zip_path, mode="w") as zf_fh:
+      zf_fh.writestr("KEIR70FL.SAS", SCHEMA)
+      zf_fh.writestr("KEIR70FL.DAT", "".join(
+          "%15s%4d%4d%d%d%4d%03d1\n" % ("d" + str(i), i // 100, i % 100,
+          1, 1, 600, 0) for i in range(RECORD_CNT)))
+    self.run_parser()
+
+    conn = sqlite3.connect(self.db_path)
+    self.assertEqual(conn.execute(
+        'SELECT COUNT(*) FROM "' + BASE_TABLE + '" '
+        'WHERE "CASEID Case Identification" LIKE \'%d%\'').fetchone()[0],
+        RECORD_CNT)
+    conn.close()
+
+if __name__ == '__main__':
+  unittest.main()